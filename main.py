@@ -1,20 +1,43 @@
 import argparse
+import hashlib
 import logging
+import mmap
 import os
 import csv
+import pickle
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
-from pyzbar.pyzbar import decode
+import numpy as np
 from PIL import Image
 
+try:
+    import zxingcpp
+    DECODER = "zxingcpp"
+except ImportError:
+    from pyzbar.pyzbar import decode
+    DECODER = "pyzbar"
+
+# Files handed to a worker at once, its loader thread reads ahead up to PREFETCH_SIZE of them
+BATCH_SIZE = 16
+PREFETCH_SIZE = 4
+IMG_EXTS = {'.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff', '.gif', '.webp', '.avif'}
+
 class DecodedObjectFile:
-    def __init__(self, code, type, filepath):
-        self.code = str(code) if code else None
+    def __init__(self, code, type, filepath, src_index=None):
+        self.code = code
         self.type = type
         self.filepath = filepath
+        self.src_index = src_index
 
     def is_not_detected(self):
         return self.code is None
 
+    def copy_to(self, filepath, src_index):
+        """Returns the same decode result for another file with identical content."""
+        return DecodedObjectFile(self.code, self.type, filepath, src_index)
+
 class DecodedObjectFileIndex:
     def create_index(dec_objs):
         code2type = {}
@@ -22,7 +45,7 @@ class DecodedObjectFileIndex:
         undetected_objs = []
         for obj in dec_objs:
             if obj.is_not_detected():
-                undetected_objs.append(obj.filepath)
+                undetected_objs.append(obj)
                 continue
 
             code2type[obj.code] = obj.type
@@ -30,7 +53,7 @@ class DecodedObjectFileIndex:
             if obj.code not in detected:
                 detected[obj.code] = []
 
-            detected[obj.code].append(obj.filepath)
+            detected[obj.code].append(obj)
 
         return DecodedObjectFileIndex(detected, undetected_objs, code2type)
 
@@ -42,65 +65,291 @@ class DecodedObjectFileIndex:
     def get_decoded_object_type(self, code):
         return self._code2type_map[code]
 
+class DecodedObjectCache:
+    """On-disk cache of decode results keyed by the BLAKE2b digest of the image file content."""
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def _entry_path(self, digest):
+        return os.path.join(self.cache_dir, digest[:2], digest + ".pkl")
+
+    def load(self, digest):
+        """Returns the cached list of (code, type) pairs or None on a cache miss."""
+        try:
+            with open(self._entry_path(digest), "rb") as file:
+                return pickle.load(file)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.warning("Ignoring unreadable cache entry %s: %s", digest, e)
+            return None
+
+    def store(self, digest, entries):
+        entry_path = self._entry_path(digest)
+        tmp_path = f"{entry_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+            with open(tmp_path, "wb") as file:
+                pickle.dump(entries, file)
+            os.replace(tmp_path, entry_path)
+        except OSError as e:
+            logging.warning("Failed to write cache entry %s: %s", digest, e)
+
 class DecodedObjectDetector:
-    def detect_objects(filepath):
-        """Detects a barcode in the given image file and returns the barcode data or None if detection fails."""
+    def __init__(self, cache=None, max_dim=None):
+        self.cache = cache
+        self.max_dim = max_dim
+
+    def detect_objects(self, filepath, src_index=None):
+        """Detects barcodes in the given image file.
+
+        Returns a single DecodedObjectFile when the file holds one barcode or none (its code is None then),
+        and a list of them only for the rare file holding several barcodes.
+        """
+        digest = self.hash_file(filepath) if self.cache else None
+        return self._detect(filepath, src_index, self._load(filepath, digest))
+
+    def detect_batch(self, filepaths, src_indices, digests):
+        """Detects barcodes in the given files whose content digests are already known, see detect_objects.
+
+        A loader thread reads and decompresses the next images while the current one is scanned for barcodes,
+        hiding file I/O behind decoding.
+        """
+        loaded_queue = queue.Queue(maxsize=PREFETCH_SIZE)
+
+        def load_all():
+            for filepath, digest in zip(filepaths, digests):
+                loaded_queue.put(self._load(filepath, digest))
+
+        loader = threading.Thread(target=load_all, daemon=True)
+        loader.start()
+        results = [self._detect(filepath, src_index, loaded_queue.get())
+                   for filepath, src_index in zip(filepaths, src_indices)]
+        loader.join()
+        return results
+
+    def hash_file(self, filepath):
+        """Returns the BLAKE2b digest of the file content or None if the file cannot be hashed."""
+        # The file is never read into a private buffer, it is hashed through a read-only mapping
+        # that workers share via the page cache
         try:
-            image = Image.open(filepath)
-            objs = decode(image)
-            if objs:
-                return [DecodedObjectFile(obj.data.decode("utf-8"), obj.type, filepath) for obj in objs]
+            with open(filepath, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return hashlib.blake2b(data, digest_size=16).hexdigest()
+        except (OSError, ValueError) as e:
+            # Reported when the file is detected, e.g. empty files cannot be mapped
+            logging.debug("Cannot hash file %s: %s", filepath, e)
+            return None
+
+    def _load(self, filepath, digest):
+        """Returns (entries, image, digest) with entries set on a cache hit and image set otherwise, None on error."""
+        try:
+            if self.cache and digest:
+                entries = self.cache.load(digest)
+                if entries is not None:
+                    return entries, None, digest
+
+            # PIL streams the image from the open file
+            with open(filepath, "rb") as file:
+                return None, self._load_image(file), digest
         except Exception as e:
             logging.error(f"Error detecting barcode in {filepath}: {e}")
+        return None
+
+    def _detect(self, filepath, src_index, loaded):
+        if loaded is not None:
+            entries, image, digest = loaded
+            try:
+                if entries is None:
+                    entries = self._decode_image(image)
+                    if self.cache and digest:
+                        self.cache.store(digest, entries)
+
+                if len(entries) == 1:
+                    code, type = entries[0]
+                    return DecodedObjectFile(code, type, filepath, src_index)
+                if entries:
+                    return self._detect_many(entries, filepath, src_index)
+            except Exception as e:
+                logging.error(f"Error detecting barcode in {filepath}: {e}")
         logging.warning("Detected NO barcode in file %s", filepath)
-        return [DecodedObjectFile(None, None, filepath)]
+        return DecodedObjectFile(None, None, filepath, src_index)
+
+    def _detect_many(self, entries, filepath, src_index):
+        return [DecodedObjectFile(code, type, filepath, src_index) for code, type in entries]
+
+    def _load_image(self, fp):
+        """Loads the image from the given file object as a grayscale image no larger than max_dim."""
+        image = Image.open(fp)
+        draft_size = image.size
+        if self.max_dim and max(image.size) > self.max_dim:
+            scale = self.max_dim / max(image.size)
+            draft_size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        # Let JPEG decode straight to grayscale, and at 1/2, 1/4 or 1/8 scale when oversized,
+        # both decoders only scan a single 8bpp plane
+        image.draft("L", draft_size)
+        image = image.convert("L")
+        if self.max_dim:
+            image.thumbnail((self.max_dim, self.max_dim), Image.BILINEAR)
+        return image
+
+    def _decode_image(self, image):
+        """Returns the (code, type) pairs found in the given grayscale image, barcodes with no data are skipped."""
+        if DECODER == "zxingcpp":
+            # Upper-cased format names match the pyzbar type names, e.g. QRCode -> QRCODE
+            return [(res.text, res.format.name.upper()) for res in zxingcpp.read_barcodes(np.asarray(image)) if res.text]
+
+        width, height = image.size
+        return [(obj.data.decode("utf-8"), obj.type) for obj in decode((image.tobytes(), width, height)) if obj.data]
+
+def iter_image_files(dirpath):
+    """Recursively yields image file paths under dirpath in the same order as os.walk."""
+    subdirpaths = []
+    try:
+        with os.scandir(dirpath) as entries:
+            for entry in entries:
+                # DirEntry caches the file type from the directory listing, no extra stat for regular entries
+                if entry.is_dir(follow_symlinks=False):
+                    subdirpaths.append(entry.path)
+                elif os.path.splitext(entry.name)[1].lower() not in IMG_EXTS:
+                    logging.debug("Skipping non-image file %s", entry.path)
+                elif entry.is_file():
+                    yield entry.path
+    except OSError as e:
+        logging.error("Error listing directory %s: %s", dirpath, e)
+
+    for subdirpath in subdirpaths:
+        yield from iter_image_files(subdirpath)
+
+def detect_files(executor, detector, filepaths, src_indices):
+    """Detects barcodes in all given files on the executor and returns the flat list of DecodedObjectFile.
+
+    Files are hashed first so that identical files, which are common across the compared directories,
+    are decoded only once and the copies reuse that result.
+    """
+    digests = list(executor.map(detector.hash_file, filepaths, chunksize=BATCH_SIZE))
+
+    first_ids = {}
+    unique_ids = []
+    for file_id, digest in enumerate(digests):
+        # Files that could not be hashed are always detected on their own
+        if digest is None:
+            unique_ids.append(file_id)
+        elif digest not in first_ids:
+            first_ids[digest] = file_id
+            unique_ids.append(file_id)
+
+    batch_ids = [unique_ids[start:start + BATCH_SIZE] for start in range(0, len(unique_ids), BATCH_SIZE)]
+    filepath_batches = [[filepaths[file_id] for file_id in ids] for ids in batch_ids]
+    src_index_batches = [[src_indices[file_id] for file_id in ids] for ids in batch_ids]
+    digest_batches = [[digests[file_id] for file_id in ids] for ids in batch_ids]
+
+    results = {}
+    batch_results = executor.map(detector.detect_batch, filepath_batches, src_index_batches, digest_batches)
+    for ids, batch_res in zip(batch_ids, batch_results):
+        results.update(zip(ids, batch_res))
+
+    dec_objs = []
+    for file_id, digest in enumerate(digests):
+        res = results.get(file_id)
+        if res is None:
+            filepath = filepaths[file_id]
+            first_res = results[first_ids[digest]]
+            logging.debug("Reusing decode result for identical file %s", filepath)
+            if isinstance(first_res, list):
+                res = [obj.copy_to(filepath, src_indices[file_id]) for obj in first_res]
+            else:
+                res = first_res.copy_to(filepath, src_indices[file_id])
+                if res.is_not_detected():
+                    logging.warning("Detected NO barcode in file %s", filepath)
+
+        if isinstance(res, list):
+            dec_objs.extend(res)
+        else:
+            dec_objs.append(res)
+    return dec_objs
+
+def init_worker(log_level):
+    """Configures logging in a worker process, handlers are not inherited on spawn."""
+    logging.basicConfig(level=log_level, format='%(levelname)s: %(message)s')
 
 class DecodedObjectFolderComparison:
     def __init__(self, obj_index, cmp_dirpaths):
         self.obj_index = obj_index
         self.cmp_dirpaths = cmp_dirpaths
+        # Every file was found by walking its source directory, so its relative path is a plain slice
+        self.cmp_prefix_lens = [len(os.path.join(dirpath, "")) for dirpath in cmp_dirpaths]
         self.cmp_res = {}
+        self.cmp_subpaths = {}
 
     def compare(self):
-        for code, filepaths in self.obj_index.detected.items():
-            count_arr = [0 for _ in self.cmp_dirpaths]
-            for filepath in filepaths:
-                for i, dirpath in enumerate(self.cmp_dirpaths):
-                    if filepath.startswith(dirpath + os.sep):
-                        count_arr[i] += 1
+        # Hot loops below use locals rather than repeated attribute lookups
+        detected = self.obj_index.detected
+        dirpaths = self.cmp_dirpaths
+        prefix_lens = self.cmp_prefix_lens
+        cmp_res = self.cmp_res
+        cmp_subpaths = self.cmp_subpaths
+
+        codes = list(detected)
+        code_ids = []
+        dir_ids = []
+        for code_id, (code, objs) in enumerate(detected.items()):
+            subpaths_arr = [[] for _ in dirpaths]
+            for obj in objs:
+                src_index = obj.src_index
+                code_ids.append(code_id)
+                dir_ids.append(src_index)
+                subpaths_arr[src_index].append(obj.filepath[prefix_lens[src_index]:])
+            cmp_subpaths[code] = subpaths_arr
 
-            self.cmp_res[code] = []
+        # counts[code_id, dir_id] is the number of files holding the code in that directory
+        counts = np.zeros((len(codes), len(dirpaths)), dtype=np.int32)
+        np.add.at(counts, (np.array(code_ids, dtype=np.int32), np.array(dir_ids, dtype=np.int32)), 1)
+        match_all = (counts == 1).all(axis=1).tolist()
+        missing = (counts == 0).any(axis=1).tolist()
+        duplicated = (counts > 1).any(axis=1).tolist()
 
-            if all(cnt == 1 for cnt in count_arr):
-                self.cmp_res[code].append('MATCH_ALL')
+        for code_id, code in enumerate(codes):
+            res = cmp_res[code] = []
+
+            if match_all[code_id]:
+                res.append('MATCH_ALL')
             else:
-                if any(cnt == 0 for cnt in count_arr):
-                    self.cmp_res[code].append('MISSING')
-                if any(cnt > 1 for cnt in count_arr):
-                    self.cmp_res[code].append('DUPLICATED')
+                if missing[code_id]:
+                    res.append('MISSING')
+                if duplicated[code_id]:
+                    res.append('DUPLICATED')
 
-                if (len(self.cmp_res[code]) == 0):
-                    self.cmp_res[code].append('INVALID')
+                if (len(res) == 0):
+                    res.append('INVALID')
         return self._compare_result()
 
     def _compare_result(self):
         header = ["Compare Result", "CODE", "Decoded Type", *self.cmp_dirpaths]
-        rows = []
-
-        for code, filepaths in self.obj_index.detected.items():
-            row = [self.cmp_res[code], code, self.obj_index.get_decoded_object_type(code)]
-            for dirpath in self.cmp_dirpaths:
-                subpaths = [os.path.relpath(fp, dirpath) for fp in filepaths if fp.startswith(dirpath + os.sep)]
-                row.append(subpaths)
+        code2type = self.obj_index._code2type_map
+        cmp_res = self.cmp_res
+        prefix_lens = self.cmp_prefix_lens
+        undetected = self.obj_index.undetected
 
-            rows.append(row)
+        # Report is built column by column with every cell already a string, rows are zipped at the end
+        codes = list(self.cmp_subpaths)
+        col_result = ['\n'.join(cmp_res[code]) for code in codes]
+        col_result.extend("NO_DETECTED" for _ in undetected)
+        col_code = codes + ["None" for _ in undetected]
+        col_type = [code2type[code] for code in codes]
+        col_type.extend("None" for _ in undetected)
 
-        for fp in self.obj_index.undetected:
-            row = ["NO_DETECTED", "None", "None"]
-            for dirpath in self.cmp_dirpaths:
-                row.append(os.path.relpath(fp, dirpath) if fp.startswith(dirpath + os.sep) else "")
+        col_subpaths = [[] for _ in prefix_lens]
+        for subpaths_arr in self.cmp_subpaths.values():
+            for col, subpaths in zip(col_subpaths, subpaths_arr):
+                col.append('\n'.join(subpaths))
+        # An undetected file fills only its own source column, pad every column once and set that cell
+        offset = len(codes)
+        for col in col_subpaths:
+            col.extend([""] * len(undetected))
+        for row_id, obj in enumerate(undetected, offset):
+            col_subpaths[obj.src_index][row_id] = obj.filepath[prefix_lens[obj.src_index]:]
 
-            rows.append(row)
+        rows = zip(col_result, col_code, col_type, *col_subpaths)
         return header, rows
 
 def main():
@@ -109,9 +358,18 @@ def main():
     parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
                         help="Set logging level (default: INFO)")
     parser.add_argument("--report-dir", default=os.getcwd(), help="Report directory path (default: current working directory)")
+    parser.add_argument("--cache-dir", default=os.path.join(os.path.expanduser("~"), ".cache", "qr_compare"),
+                        help="Decode result cache directory (default: ~/.cache/qr_compare)")
+    parser.add_argument("--no-cache", action="store_true", help="Disable the decode result cache")
+    parser.add_argument("--max-dim", type=int, default=2000,
+                        help="Downscale images larger than this many pixels on either side before decoding, 0 to disable (default: 2000)")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="Number of workers (default: CPU count)")
+    parser.add_argument("--executor", default="process", choices=["process", "thread"],
+                        help="Run workers as processes or as threads sharing this process (default: process)")
 
     args = parser.parse_args()
-    logging.basicConfig(level=getattr(logging, args.log_level), format='%(levelname)s: %(message)s')
+    log_level = getattr(logging, args.log_level)
+    init_worker(log_level)
 
     src_dirpaths = [os.path.abspath(src) for src in args.src_dir]
     report_dirpath = os.path.abspath(args.report_dir)
@@ -127,31 +385,45 @@ def main():
         logging.error("Report directory does not exist: %s", report_dirpath)
         exit(1)
 
-    dec_objs = []
-    for src_dirpath in src_dirpaths:
-        for dirpath, _, filenames in os.walk(src_dirpath):
-            for filename in filenames:
-                filepath = os.path.join(dirpath, filename)
-                dec_objs_in_file = DecodedObjectDetector.detect_objects(filepath)
-                dec_objs.extend(dec_objs_in_file)
+    if args.max_dim < 0:
+        logging.error("Maximum image dimension must not be negative: %d", args.max_dim)
+        exit(1)
+
+    if args.jobs < 1:
+        logging.error("Number of jobs must be at least 1: %d", args.jobs)
+        exit(1)
+
+    filepaths = []
+    src_indices = []
+    for src_index, src_dirpath in enumerate(src_dirpaths):
+        for filepath in iter_image_files(src_dirpath):
+            filepaths.append(filepath)
+            src_indices.append(src_index)
+
+    logging.debug("Decoding barcodes with %s", DECODER)
+    # Decoders and downscale limits may disagree on the same image, keep their cached results apart
+    cache_namespace = f"{DECODER}-{args.max_dim}"
+    cache = None if args.no_cache else DecodedObjectCache(os.path.join(os.path.abspath(args.cache_dir), cache_namespace))
+    detector = DecodedObjectDetector(cache, args.max_dim)
+
+    # pyzbar and PIL release the GIL while decoding, threads avoid process start-up and pickling costs
+    if args.executor == "thread":
+        executor = ThreadPoolExecutor(max_workers=args.jobs)
+    else:
+        executor = ProcessPoolExecutor(max_workers=args.jobs, initializer=init_worker, initargs=(log_level,))
+
+    with executor:
+        dec_objs = detect_files(executor, detector, filepaths, src_indices)
 
     obj_index = DecodedObjectFileIndex.create_index(dec_objs)
 
     obj_compare = DecodedObjectFolderComparison(obj_index, src_dirpaths)
     header, rows = obj_compare.compare()
 
-    with open(report_filepath, mode="w", newline="") as file:
-        def format_csv_record(val):
-            if isinstance(val, (list, tuple)):
-                return '\n'.join(val)
-            else:
-                return val
-
+    with open(report_filepath, mode="w", newline="", buffering=1 << 20) as file:
         writer = csv.writer(file)
         writer.writerow(header)
-        for row in rows:
-            fmt_row = [format_csv_record(val) for val in row]
-            writer.writerow(fmt_row)
+        writer.writerows(rows)
 
 if __name__ == "__main__":
     main()